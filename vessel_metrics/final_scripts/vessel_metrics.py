@@ -274,29 +274,35 @@ def find_terminal_segments(skel, edge_labels):
     return terminal_segments
 
 
-def preprocess_czi(input_directory, file_name, channel=0):
+def load_czi_channel(input_directory, file_name, channel=0):
     from aicsimageio import AICSImage
-    import numpy as np
 
-    # Load image metadata (no full image in RAM yet)
+    # Load image metadata (no full image in RAM yet); chunk on Y/X only so
+    # every Z plane is its own dask chunk (the reader default chunks ZYX together)
     img = AICSImage(
         input_directory + file_name,
-        reader=aicsimageio.readers.CziReader
+        reader=aicsimageio.readers.CziReader,
+        chunk_dims=["Y", "X"],
     )
 
+    # Separate crop sizes for Y and X
+    crop_y = 3000
+    crop_x = 2000
+    downsample_factor = 2
+
+    # Pixel sizes of the returned (downsampled) image, not of the raw file
     dims = img.physical_pixel_sizes
     zdim, ydim, xdim = dims[0], dims[1], dims[2]
+    if ydim is not None:
+        ydim = ydim * downsample_factor
+    if xdim is not None:
+        xdim = xdim * downsample_factor
     out_dims = [zdim, ydim, xdim]
 
     # Get image shape in ZYX order for the requested channel
     data_shape = img.get_image_dask_data("ZYX", T=0, C=channel).shape
     z, y, x = data_shape
 
-    # Separate crop sizes for Y and X
-    crop_y = 3000
-    crop_x = 2000
-    downsample_factor = 2
-
     # Calculate crop coordinates around the center
     yc, xc = y // 2, x // 2
     y1, y2 = yc - crop_y // 2, yc + crop_y // 2
@@ -314,6 +320,28 @@ def preprocess_czi(input_directory, file_name, channel=0):
 
     print(f"[DEBUG] Downsampled region shape (pre-compute): {cropped_dask.shape}")
 
+    if any(size != 1 for size in cropped_dask.chunks[0]):
+        print(f"[WARNING] Z is not chunked per plane: {cropped_dask.chunks[0]}")
+
+    return cropped_dask, out_dims
+
+
+def iter_czi_slices(volume):
+    # Yield a lazy (Z, Y, X) volume one native Z chunk at a time so only
+    # a single chunk is held in memory (one plane with load_czi_channel's chunking)
+    start = 0
+    for size in volume.chunks[0]:
+        yield volume[start : start + size].compute()
+        start += size
+
+
+def preprocess_czi(input_directory, file_name, channel=0):
+    import numpy as np
+
+    cropped_dask, out_dims = load_czi_channel(
+        input_directory, file_name, channel=channel
+    )
+
     # Load into memory now as float32
     image = cropped_dask.compute().astype(np.float32)
 
@@ -1,16 +1,31 @@
 #!/usr/bin/env python3
 
+import gc
 import os
 import time
 import sys
 import numpy as np
 import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import PIL
 from PIL import Image
+from scipy import ndimage
 
 # Add vessel_metrics to the Python path
 sys.path.append('./vessel_metrics/scripts')
 import vessel_metrics as vm
 
+# zlib level for the output PNGs; level 1 encodes several times faster than
+# Pillow's default (6) at nearly the same file size for these images
+PNG_COMPRESS_LEVEL = 1
+
+# the original projection is a lossy review preview; the binary masks stay PNG
+JPEG_QUALITY = 90
+
+# substrings identifying pixel-size entries in a dims dict
+PIXEL_SIZE_KEYWORDS = ('physical', 'voxel', 'spacing')
+
 
 def format_sig(x, sig=4):
     """Format a numeric value to `sig` significant digits (returns str)."""
@@ -22,6 +37,46 @@ def format_sig(x, sig=4):
         return str(x)
 
 
+def format_sig_arr(a, sig=4):
+    """Array version of format_sig: format every element to `sig` significant digits (returns list of str)."""
+    return np.char.mod(f'%.{sig}g', np.asarray(a, dtype=np.float64)).tolist()
+
+
+def to_uint8(arr, scale=255, out=None):
+    """Scale `arr` by `scale` and cast to uint8 in one ufunc pass (no float temporary).
+    Pass `out` to reuse an existing uint8 buffer of the same shape. The default integer
+    scale keeps integer/bool inputs in integer arithmetic, matching (arr * 255).astype(np.uint8)."""
+    if out is None:
+        out = np.empty(arr.shape, dtype=np.uint8)
+    np.multiply(arr, scale, out=out, casting='unsafe')
+    return out
+
+
+def save_image(arr, path, description, scale=255, out=None, **save_kwargs):
+    """Convert `arr` to uint8 and write it with PIL (format from the extension, options in
+    `save_kwargs`); runs on the save pool so encoding overlaps compute.
+    Returns the uint8 buffer so the next save can reuse it once this one has finished."""
+    out = to_uint8(arr, scale, out=out)
+    Image.fromarray(out).save(path, **save_kwargs)
+    print(f"Saved {description}: {path}", flush=True)
+    return out
+
+
+def zmax_stream(volume):
+    """
+    Max intensity projection of a lazy (Z, Y, X) volume, reading one Z chunk at a time.
+    Peak memory is one chunk plus the 2D accumulator instead of the full stack
+    (load_czi_channel chunks per Z plane, so ~2 x Y x X).
+    """
+    acc = None
+    for block in vm.iter_czi_slices(volume):
+        if acc is None:
+            acc = block.max(axis=0)
+        else:
+            np.maximum(acc, block.max(axis=0), out=acc)
+    return acc
+
+
 def get_pixel_size_from_dims(dims):
     """
     Try to extract a pixel size (microns per pixel) from dims returned by preprocess_czi.
@@ -35,23 +90,32 @@ def get_pixel_size_from_dims(dims):
 
     # If dims is a dict and contains typical keys
     if isinstance(dims, dict):
-        # common keys might be 'PhysicalSizeY', 'PhysicalSizeX' or similar
-        for key in dims:
+        # common keys might be 'PhysicalSizeY', 'PhysicalSizeX' or similar;
+        # match on the trailing axis letter ('physical' itself contains a 'y')
+        found_y = found_x = False
+        for key, value in dims.items():
             kl = key.lower()
-            if 'physical' in kl or 'voxel' in kl or 'spacing' in kl:
-                try:
-                    # try various likely keys
-                    if 'y' in kl:
-                        px_y = float(dims[key])
-                    if 'x' in kl:
-                        px_x = float(dims[key])
-                except Exception:
-                    pass
-        # if both still default but dims dict contains numeric values, try to take any numeric items
-        numeric_vals = [v for v in dims.values() if isinstance(v, (int, float))]
-        if len(numeric_vals) >= 2:
-            px_y, px_x = float(numeric_vals[0]), float(numeric_vals[1])
+            if not any(word in kl for word in PIXEL_SIZE_KEYWORDS):
+                continue
+            try:
+                if kl.endswith('y'):
+                    px_y = float(value)
+                    found_y = True
+                elif kl.endswith('x'):
+                    px_x = float(value)
+                    found_x = True
+            except Exception:
+                pass
+            if found_y and found_x:
+                break
+        if found_y and found_x:
             unit = 'micrometers'
+        else:
+            # no explicit keys: fall back to the first two numeric items
+            numeric_vals = [v for v in dims.values() if isinstance(v, (int, float))]
+            if len(numeric_vals) >= 2:
+                px_y, px_x = float(numeric_vals[0]), float(numeric_vals[1])
+                unit = 'micrometers'
     elif isinstance(dims, (list, tuple, np.ndarray)):
         # some libraries return (z_spacing, y_spacing, x_spacing)
         try:
@@ -88,10 +152,22 @@ def get_pixel_size_from_dims(dims):
     return float(px_y), float(px_x), unit
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Vessel metrics pipeline for a CZI stack")
+    parser.add_argument(
+        '--save-intermediates', action='store_true',
+        help="also write the segmentation, skeleton and overlay PNGs (off by default)"
+    )
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
+
     print(">>> Script started successfully.", flush=True)
     print(f"Working directory: {os.getcwd()}", flush=True)
     print(f"Python version: {sys.version}", flush=True)
+    print(f"Pillow version: {PIL.__version__}", flush=True)
     print("Checking if file exists...", flush=True)
 
     data_path = './'  # Current directory
@@ -107,10 +183,17 @@ def main():
     time.sleep(10)
     print("Continuing to load CZI...", flush=True)
 
+    # Image encoding releases the GIL, so the saves run in the background. Two
+    # workers suffice: the mask saves hand one buffer along and so run one at a
+    # time, at most alongside the projection preview.
+    save_pool = ThreadPoolExecutor(max_workers=2)
+    save_futures = []
+
     try:
         # Step 1: Load CZI file (CD31 channel = 1)
         print("Loading CZI file...", flush=True)
-        volume, dims = vm.preprocess_czi(data_path, file_name, channel=1)
+        # volume is a lazy dask array; Z chunks are only read while projecting
+        volume, dims = vm.load_czi_channel(data_path, file_name, channel=1)
         print(f"Loaded volume shape: {volume.shape}", flush=True)
         print(f"Physical dimensions: {dims}", flush=True)
 
@@ -118,133 +201,205 @@ def main():
         px_y, px_x, unit_name = get_pixel_size_from_dims(dims)
         print(f"Interpreted pixel size: y={px_y} {unit_name}/px, x={px_x} {unit_name}/px", flush=True)
 
-        volume = volume.astype(np.float32)
+        # use average pixel size in x/y for diameter conversion
+        mean_pixel_size = (px_x + px_y) / 2.0
+
+        # oversampled images (< 1 unit/px, measured on the downsampled image
+        # load_czi_channel returns) cannot resolve vessels at every small
+        # scale, so evaluate every other sigma in the small-vessel group
+        if mean_pixel_size < 1.0:
+            sigmas_small = range(1, 8, 2)
+        else:
+            sigmas_small = range(1, 8, 1)
+        print(f"Frangi small-vessel sigmas: {list(sigmas_small)}", flush=True)
 
         # Step 2: Create 2D projection by max intensity along Z
+        # (max is monotonic, so project in the native dtype and cast/normalize only the 2D result)
         print("Creating 2D projection...", flush=True)
-        vessel_raw = np.max(volume, axis=0)
-        print(f"2D projection shape: {vessel_raw.shape}", flush=True)
-
-        # Save original fluorescence projection as PNG
-        original_image_path = os.path.join(output_dir, "original_projection_fixed_test3.png")
-        Image.fromarray(
-            (vessel_raw / np.max(vessel_raw) * 255).astype(np.uint8)
-        ).save(original_image_path)
-        print(f"Saved original projection image: {original_image_path}", flush=True)
+        vessel_raw = zmax_stream(volume).astype(np.float32, copy=False)
+        vessel_raw = vm.normalize_contrast(vessel_raw)
+        del volume
+        gc.collect()
+        image_shape = vessel_raw.shape
+        print(f"2D projection shape: {image_shape}", flush=True)
+
+        # Save original fluorescence projection as a JPEG preview
+        original_image_path = os.path.join(output_dir, "original_projection_fixed_test3.jpg")
+        raw_max = float(vessel_raw.max())
+        raw_scale = np.float32(255.0 / raw_max) if raw_max > 0 else np.float32(0.0)
+        save_futures.append(save_pool.submit(
+            save_image, vessel_raw, original_image_path, "original projection image", raw_scale,
+            quality=JPEG_QUALITY, optimize=False, progressive=False
+        ))
 
         # Step 3: Preprocess for segmentation
         print("Preprocessing for segmentation...", flush=True)
         vessel_preproc = vm.preprocess_seg(vessel_raw)
+        # only the pending JPEG save still needs the raw projection; drop ours
+        # so it is freed before the multi-scale Frangi step
+        del vessel_raw
 
         # Step 4: Segment vessels
         print("Segmenting vessels...", flush=True)
-        vessel_seg = vm.segment_image(
+        # vessel_preproc already went through vm.preprocess_seg (the same call
+        # segment_image makes internally), so don't preprocess it a second time.
+        # preprocess_seg is not idempotent (top-hat and median run again), so this
+        # changes the Frangi input: masks and metrics differ from the double-filtered
+        # baseline, and thresh=60 was tuned on that double-filtered image.
+        # keep the mask as bool from here on (1 byte/px instead of the int label image)
+        vessel_seg = np.asarray(vm.segment_image(
             vessel_preproc,
             filter='frangi',
-            sigma1=range(1, 8, 1),
+            sigma1=sigmas_small,
             sigma2=range(10, 20, 5),
             hole_size=50,
             ditzle_size=500,
             thresh=60,
-            preprocess=True,
+            preprocess=False,
             multi_scale=True
-        )
+        ), dtype=bool)
         print("Segmentation complete", flush=True)
 
         # Save raw segmentation image
-        seg_path = os.path.join(output_dir, "vessel_segmentation18000_fixed_test3.png")
-        Image.fromarray((vessel_seg * 255).astype(np.uint8)).save(seg_path)
-        print(f"Saved vessel segmentation image: {seg_path}", flush=True)
+        if args.save_intermediates:
+            seg_path = os.path.join(output_dir, "vessel_segmentation18000_fixed_test3.png")
+            # The three mask images share one uint8 scratch buffer, handed from each
+            # save to the next; the compute between saves means the wait is ~free
+            mask_buf = np.empty(image_shape, dtype=np.uint8)
+            mask_save = save_pool.submit(
+                save_image, vessel_seg, seg_path, "vessel segmentation image", out=mask_buf,
+                compress_level=PNG_COMPRESS_LEVEL
+            )
+            save_futures.append(mask_save)
 
         # Step 5: Skeletonization
         print("Skeletonizing vessels...", flush=True)
         skel, edges, branchpoints = vm.skeletonize_vm(vessel_seg)
 
         # Save skeleton image
-        skel_path = os.path.join(output_dir, "vessel_skeleton18000_fixed_test3.png")
-        Image.fromarray((skel * 255).astype(np.uint8)).save(skel_path)
-        print(f"Saved vessel skeleton image: {skel_path}", flush=True)
+        if args.save_intermediates:
+            skel_path = os.path.join(output_dir, "vessel_skeleton18000_fixed_test3.png")
+            mask_save = save_pool.submit(
+                save_image, skel, skel_path, "vessel skeleton image", out=mask_save.result(),
+                compress_level=PNG_COMPRESS_LEVEL
+            )
+            save_futures.append(mask_save)
 
         # Step 6: Calculate metrics
         print("Calculating vessel metrics...", flush=True)
-        _, edge_labels = vm.cv2.connectedComponents(edges)
-
-        # whole_anatomy_diameter returns viz, list_of_(segment_id, diameter)
-        viz, output_diameters = vm.whole_anatomy_diameter(vessel_preproc, vessel_seg, edge_labels)
-
-        # Extract numeric diameters and included segment IDs
-        included_segments = [int(sid) for (sid, d) in output_diameters]
-        diameter_values = [float(d) for (sid, d) in output_diameters]
+        # 8-connected labelling (same connectivity as cv2.connectedComponents); any
+        # nonzero pixel is foreground, so the uint8 skeleton is labelled without a cast.
+        # The segments are identical to cv2's but numbered differently, so Segment_ID
+        # values and the row order of individual_vessels2.csv differ from cv2-based runs.
+        edge_labels, _ = ndimage.label(edges, structure=np.ones((3, 3), dtype=bool))
+
+        # vessel and branchpoint density are independent of the diameter measurement,
+        # so run them alongside it. vm.vessel_density re-binarizes vessel_seg in place
+        # (label[label > 0] = 1) while whole_anatomy_diameter and the segmentation save
+        # read it; the mask is already 0/1, so those writes never change a value.
+        with ThreadPoolExecutor(max_workers=2) as metrics_pool:
+            density_future = metrics_pool.submit(vm.vessel_density, vessel_preproc, vessel_seg, 16, 16)
+            bp_future = metrics_pool.submit(vm.branchpoint_density, vessel_seg)
+
+            # whole_anatomy_diameter returns viz, list_of_(segment_id, diameter)
+            # whole_anatomy_diameter draws its overlay into zeros_like(seg), so hand it a
+            # zero-copy uint8 view of the mask rather than the bool array itself
+            viz, output_diameters = vm.whole_anatomy_diameter(vessel_preproc, vessel_seg.view(np.uint8), edge_labels)
+
+            _, vessel_density, _ = density_future.result()
+            bp_density, _ = bp_future.result()
+
+        # Extract numeric diameters and included segment IDs in one unpack
+        if len(output_diameters):
+            output_diameters_np = np.asarray(output_diameters, dtype=np.float64)
+        else:
+            output_diameters_np = np.empty((0, 2), dtype=np.float64)
+        included_ids = output_diameters_np[:, 0].astype(np.intp)
+        diameter_values = output_diameters_np[:, 1]
 
         # compute per-segment lengths (in pixels) using edge_labels
-        lengths_pixels = [int(np.count_nonzero(edge_labels == sid)) for sid in included_segments]
+        # (one bincount pass over the label image instead of a mask per segment)
+        counts = np.bincount(edge_labels.ravel())
+        per_segment_length = counts[included_ids]
+        total_kept_length = int(per_segment_length.sum())
+
+        # skeleton pixel count; same as vm.network_length(edges) without binarizing edges in place
+        net_length = int(np.count_nonzero(edges))
 
-        net_length = vm.network_length(edges)  # presumably in pixels
-        _, vessel_density, _ = vm.vessel_density(vessel_preproc, vessel_seg, 16, 16)
-        bp_density, _ = vm.branchpoint_density(vessel_seg)
+        # the image-sized working arrays are not needed for the CSV export
+        del vessel_preproc, edges, edge_labels
+        gc.collect()
 
         # If no diameters found, safe defaults
-        if len(diameter_values) > 0:
-            mean_diameter_px = float(np.mean(diameter_values))
-            std_diameter_px = float(np.std(diameter_values))
+        if diameter_values.size > 0:
+            mean_diameter_px = float(diameter_values.mean())
+            std_diameter_px = float(diameter_values.std())
         else:
             mean_diameter_px = 0.0
             std_diameter_px = 0.0
 
         # convert px -> physical units if available
-        # use average pixel size in x/y for diameter conversion
-        mean_pixel_size = (px_x + px_y) / 2.0
         mean_diameter_phys = mean_diameter_px * mean_pixel_size
         std_diameter_phys = std_diameter_px * mean_pixel_size
 
         # Save overlay visualization (scaled to 0-255)
-        overlay_path = os.path.join(output_dir, "vessel_segmentation_overlay_test2.png")
-        Image.fromarray((viz * 255).astype(np.uint8)).save(overlay_path)
-        print(f"Saved vessel segmentation overlay image: {overlay_path}", flush=True)
+        if args.save_intermediates:
+            overlay_path = os.path.join(output_dir, "vessel_segmentation_overlay_test2.png")
+            mask_save = save_pool.submit(
+                save_image, viz, overlay_path, "vessel segmentation overlay image", out=mask_save.result(),
+                compress_level=PNG_COMPRESS_LEVEL
+            )
+            save_futures.append(mask_save)
 
         # Step 7: Export metrics to CSV
         metrics_path = os.path.join(output_dir, "vessel_metrics2.csv")
-        with open(metrics_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Metric', 'Value', 'Unit'])
+        summary_rows = [
+            ['Metric', 'Value', 'Unit'],
 
-            writer.writerow(['Total Network Length (skeleton pixels)', format_sig(net_length), 'pixels'])
+            ['Total Network Length (skeleton pixels)', format_sig(net_length), 'pixels'],
             # if physical conversion for length is desired: net_length * mean_pixel_size
-            writer.writerow(['Total Network Length (physical)', format_sig(net_length * mean_pixel_size), unit_name + '/px * pixels'])
+            ['Total Network Length (physical)', format_sig(net_length * mean_pixel_size), unit_name + '/px * pixels'],
 
-            writer.writerow(['Vessel Density', format_sig(vessel_density), 'ratio'])
-            writer.writerow(['Branchpoint Density', format_sig(bp_density), 'per unit area'])
+            ['Vessel Density', format_sig(vessel_density), 'ratio'],
+            ['Branchpoint Density', format_sig(bp_density), 'per unit area'],
 
-            writer.writerow(['Mean Diameter (pixels)', format_sig(mean_diameter_px), 'pixels'])
-            writer.writerow([f'Mean Diameter ({unit_name})', format_sig(mean_diameter_phys), unit_name])
+            ['Mean Diameter (pixels)', format_sig(mean_diameter_px), 'pixels'],
+            [f'Mean Diameter ({unit_name})', format_sig(mean_diameter_phys), unit_name],
 
-            writer.writerow(['Std Diameter (pixels)', format_sig(std_diameter_px), 'pixels'])
-            writer.writerow([f'Std Diameter ({unit_name})', format_sig(std_diameter_phys), unit_name])
+            ['Std Diameter (pixels)', format_sig(std_diameter_px), 'pixels'],
+            [f'Std Diameter ({unit_name})', format_sig(std_diameter_phys), unit_name],
 
-            writer.writerow(['Number of Vessels (counted segments)', format_sig(len(diameter_values)), 'count'])
-            writer.writerow(['Image Width', vessel_raw.shape[1], 'pixels'])
-            writer.writerow(['Image Height', vessel_raw.shape[0], 'pixels'])
+            ['Number of Vessels (counted segments)', format_sig(diameter_values.size), 'count'],
+            ['Image Width', image_shape[1], 'pixels'],
+            ['Image Height', image_shape[0], 'pixels'],
+            # appended last so the earlier rows keep their positions
+            ['Measured Segment Length (skeleton pixels)', format_sig(total_kept_length), 'pixels'],
+        ]
+        with open(metrics_path, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerows(summary_rows)
         print(f"Saved vessel metrics CSV: {metrics_path}", flush=True)
 
         # Export individual vessel data (both pixels and physical units)
+        # columns are converted and formatted as whole arrays (format_sig_arr), then written in one call
         vessel_data_path = os.path.join(output_dir, "individual_vessels2.csv")
+        vessel_rows = list(zip(
+            range(1, included_ids.size + 1),
+            included_ids.tolist(),
+            format_sig_arr(per_segment_length),
+            format_sig_arr(per_segment_length * mean_pixel_size),
+            format_sig_arr(diameter_values),
+            format_sig_arr(diameter_values * mean_pixel_size),
+        ))
         with open(vessel_data_path, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(['Vessel_ID', 'Segment_ID', 'Length_pixels', f'Length_{unit_name}', 'Mean_Diameter_pixels', f'Mean_Diameter_{unit_name}'])
-
-            for idx, (seg_id, diam_px, length_px) in enumerate(zip(included_segments, diameter_values, lengths_pixels)):
-                length_phys = length_px * mean_pixel_size
-                diam_phys = diam_px * mean_pixel_size
-                writer.writerow([
-                    idx + 1,
-                    seg_id,
-                    format_sig(length_px),
-                    format_sig(length_phys),
-                    format_sig(diam_px),
-                    format_sig(diam_phys)
-                ])
+            writer.writerows(vessel_rows)
         print(f"Saved individual vessel data CSV: {vessel_data_path}", flush=True)
 
+        # Wait for the background image saves (re-raises any save error)
+        for fut in save_futures:
+            fut.result()
+
         print("\n=== Analysis Complete ===", flush=True)
         print(f"Outputs saved to directory: {output_dir}", flush=True)
 
@@ -252,7 +407,15 @@ def main():
         import traceback
         print(f"Error during processing: {e}", flush=True)
         traceback.print_exc()
+        # join the pending saves so their failures are reported too
+        save_pool.shutdown(wait=True)
+        for fut in save_futures:
+            save_error = fut.exception()
+            if save_error is not None and save_error is not e:
+                print(f"Error while saving image: {save_error}", flush=True)
         sys.exit(1)
+    finally:
+        save_pool.shutdown(wait=True)
 
 
 if __name__ == "__main__":